@@ -3,8 +3,12 @@
 This code is designed to work with the Telit ME910G1 modem connected via USB to
 a Raspberry Pi.
 """
+import asyncio
+import contextlib
 import datetime
-import io
+import functools
+import logging
+import os
 import re
 import time
 import warnings
@@ -13,6 +17,52 @@ import serial
 import serial.tools.list_ports
 import RPi.GPIO as rgp
 
+logger = logging.getLogger(__name__)
+
+# Values accepted by the SixfabBaseHat GPIO setters
+_ON_STATES = frozenset({1, True, "on"})
+_OFF_STATES = frozenset({0, False, "off"})
+
+# Final result codes which report a failed command; +CME ERROR and +CMS ERROR
+# are followed by an error description
+_ERROR_PREFIXES = ("ERROR", "+CME ERROR", "+CMS ERROR")
+
+# Matches a final result code at the end of the bytes read so far. Only the
+# tail of the buffer needs to be searched, see _read_response
+_RESULT_CODE_RE = re.compile(rb"(?:\A|\r\n)(?:OK|ERROR|NO CARRIER|\+CM[ES] ERROR[^\r\n]*)\r\n\Z")
+
+# Sign of a latitude or longitude, by hemisphere
+_HEMISPHERE_SIGN = {"N": 1, "S": -1, "E": 1, "W": -1}
+
+# Deletes any stray CR or LF left in a response line
+_CRLF_STRIP = str.maketrans("", "", "\r\n")
+
+# The fields of an AT#RFSTS response (in LTE) reported by signal_test, in
+# order: PLMN, EARFCN, RSRP, RSSI, RSRQ, TAC, RAC, CID, IMSI, network name,
+# active band and SINR. The skipped fields are TXPWR, DRX, MM, RRC, SD, T3402
+# and T3412. The network name is optional; if quoted, it may contain commas.
+_RFSTS_RE = re.compile(r'#RFSTS: "?([^",]*)"?,([^,]*),([^,]*),([^,]*),([^,]*),([^,]*),([^,]*),'
+                       r'(?:[^,]*,){4}([^,]*),"?([^",]*)"?,("[^"]*"|[^,]*),[^,]*,([^,]*),(?:[^,]*,){2}([^,]*)')
+_RFSTS_KEYS = ("plmn", "earfcn", "rsrp", "rssi", "rsrq", "tac", "rac", "cellid", "imsi", "opname", "abnd", "sinr")
+
+
+@functools.lru_cache(maxsize=64)
+def _encode_commandline(AT_commandline):
+    """Encode an AT commandline for writing; polled commands are only encoded
+    once."""
+    return (AT_commandline + "\r").encode("ascii")
+
+
+def _is_no_fix(AT_response):
+    """Check if an AT$GPSACP response reports that there is no GNSS fix yet.
+
+    Without a fix, every field is empty except for the fix field, which is 0
+    (invalid fix) or 1 (no fix); for example "$GPSACP: ,,,,,0,,,,,".
+    """
+    return (AT_response.startswith("$GPSACP: ,,,,,")
+            and AT_response[14:15] in ("0", "1")
+            and AT_response[15:] == ",,,,,")
+
 
 class SixfabBaseHat:
     """Interface to GPIO features of the Sixfab 3G/4G Base HAT."""
@@ -25,30 +75,40 @@ class SixfabBaseHat:
         rgp.setup(19, rgp.OUT, initial=rgp.LOW)
         # Power to HAT; keep same state as before (low is on, high is cut off)
         rgp.setup(26, rgp.OUT, initial=None)
+        # These pins are only driven by the setters below, so their state is
+        # cached rather than read back from the pins on every access. The
+        # power pin keeps its previous state, so read it once here.
+        self._led = False
+        self._airplane_mode = False
+        self._power = rgp.input(26) == 0
 
     @property
     def led(self):
-        return True if rgp.input(13) == 1 else False
+        return self._led
 
     @led.setter
     def led(self, state):
-        if state in {1, True, "on"}:
+        if state in _ON_STATES:
             #rgp.output(13, rgp.HIGH)
             rgp.output(27, rgp.HIGH)
-        elif state in {0, False, "off"}:
+            self._led = True
+        elif state in _OFF_STATES:
             #rgp.output(13, rgp.LOW)
             rgp.output(27, rgp.LOW)
+            self._led = False
 
     @property
     def airplane_mode(self):
-        return True if rgp.input(19) == 1 else False
+        return self._airplane_mode
 
     @airplane_mode.setter
     def airplane_mode(self, state):
-        if state in {1, True, "on"}:
+        if state in _ON_STATES:
             rgp.output(19, rgp.HIGH)
-        elif state in {0, False, "off"}:
+            self._airplane_mode = True
+        elif state in _OFF_STATES:
             rgp.output(19, rgp.LOW)
+            self._airplane_mode = False
 
     @property
     def power(self):
@@ -56,14 +116,16 @@ class SixfabBaseHat:
 
         True if the HAT is powered; False if not.
         """
-        return False if rgp.input(26) == 1 else True
+        return self._power
 
     @power.setter
     def power(self, state):
-        if state in {1, True, "on"}:
+        if state in _ON_STATES:
             rgp.output(26, rgp.LOW)
-        elif state in {0, False, "off"}:
+            self._power = True
+        elif state in _OFF_STATES:
             rgp.output(26, rgp.HIGH)
+            self._power = False
 
 
 class ModemError(RuntimeError):
@@ -97,11 +159,33 @@ class TelitME910G1(SixfabBaseHat):
     The modem is designed for LTE UE categories NB1/2 and M1.
     """
 
-    def __init__(self, baud=115200, timeout=0.1):
+    # AT#HTTPCFG=<prof_id>,<server_address>,<server_port>,<auth_type>,
+    # <username>,<password>,<ssl_enabled>,<timeout>,<cid>,<pkt_size>,...
+    # No HTTP authentication, username, password, or SSL.
+    _HTTPCFG = 'AT#HTTPCFG={},{},{},0,"","",0,{},{},{},0,0'
+    # AT#HTTPSND=<prof_id>,<command>,<resource>,<data_len>[,<post_param>]
+    # keyed by request type. The content type (post_param) is only used with
+    # POST requests.
+    _HTTPSND = {"POST": "AT#HTTPSND={},0,{},{},{}",
+                "PUT": "AT#HTTPSND={},1,{},{}"}
+    # Access technology names, by their number in AT+COPS? responses
+    _COPS_ACT = {"0": "GSM", "8": "CAT M-1", "9": "NB-IoT"}
+
+    def __init__(self, baud=115200, timeout=0.1, port=None, write_timeout=10):
         """Autodetect the modem and set serial link parameters.
 
         The last modem found is initialized (we assume there is only one modem
-        connected at a time).
+        connected at a time), unless port is given.
+
+        Args:
+            baud (int): Serial baud rate; default 115200.
+            timeout (float): Serial read timeout, in seconds; default 0.1.
+            port (str): Path to the serial device of the modem, for example
+                "/dev/ttyUSB2". If None (default), the modem is autodetected.
+            write_timeout (float): Serial write timeout, in seconds; default
+                10. Writes the modem does not accept in time (for example a
+                large HTTP payload) raise serial.SerialTimeoutException
+                instead of blocking forever.
         """
 
         super().__init__()
@@ -109,67 +193,88 @@ class TelitME910G1(SixfabBaseHat):
         # To turn on ME910G1, a certain pad must be tied low for at least 5
         # seconds, then released. Refer to Telit ME910G1 Hardware Design Guide
         # document.
-        print("DEBUG waiting 5 seconds for module power-on")
-        time.sleep(5)
-        for port in serial.tools.list_ports.comports():
+        # Rather than waiting a fixed time for power-on, poll until the serial
+        # interface of the modem shows up.
+        logger.debug("waiting for module power-on")
+        deadline = time.monotonic() + 15
+        while True:
             # Check if 0x110a is the actual product ID of the device
             # For some reason, ttyUSB2 is the "good" port
-            if port.vid == 0x1bc7 and port.pid == 0x110a:
-                self.chardev = port.device
-                print(f"Detected Telit ME910G1 serial interface at {self.chardev}")
-                break
+            if port is not None:
+                # The path may be a symlink (for example under
+                # /dev/serial/by-id), which comports() does not list
+                self.chardev = port if os.path.exists(port) else None
             else:
+                self.chardev = next((comport.device for comport in serial.tools.list_ports.comports()
+                                     if comport.vid == 0x1bc7 and comport.pid == 0x110a),
+                                    None)
+            if self.chardev is not None:
+                break
+            if time.monotonic() > deadline:
                 raise RuntimeError("Could not detect the modem serial port")
+            time.sleep(0.1)
+        if port is None:
+            print(f"Detected Telit ME910G1 serial interface at {self.chardev}")
 
         self.ser = serial.Serial(
             port=self.chardev,
             baudrate=baud,
             xonxoff=False,
             dsrdtr=True,
-            timeout=timeout
+            timeout=timeout,
+            write_timeout=write_timeout
         )
-
-        self.sio = io.TextIOWrapper(io.BufferedRWPair(self.ser, self.ser), newline="", line_buffering=True)
-
-        # At initial startup, the modem hangs waiting when trying to get
-        # response to these. Wait 3 seconds as a lazy workaround.
-        time.sleep(3)
-        with self.ser:
-            self.cmd_query("ATE0Q0V1X0&S3&K3")
-            self.cmd_query("AT+IFC=2,2;+CMEE=2")
+        self._set_low_latency_mode()
+        # Used to space out commands; see _command_guard
+        self._last_response_time = time.monotonic()
+        # Recent responses to read-only queries; see _cached_query
+        self._at_cache = {}
+        # When signal_test last logged that the modem is not registered
+        self._unregistered_logged_at = None
+
+        with self._session():
+            # At initial startup, the modem hangs waiting when trying to get
+            # response to commands. Probe with AT until it answers.
+            old_timeout = self.ser.timeout
+            self.ser.timeout = 0.2
+            deadline = time.monotonic() + 15
+            try:
+                self.ser.write(b"AT\r")
+                while b"OK" not in self.ser.read_until(b"OK\r\n", size=64):
+                    if time.monotonic() > deadline:
+                        raise ModemError("Modem did not respond to AT commands")
+                    self.ser.write(b"AT\r")
+            finally:
+                self.ser.timeout = old_timeout
+            # Same settings as the profile saved in one_time_setup, in one
+            # commandline
+            self.cmd_query("ATE0Q0V1X0&S3&K3+IFC=2,2;+CMEE=2")
         # This will not run again if the modem is powered off via the parent
         # class!
 
+    def close(self):
+        """Close the serial port; it is reopened by the next command."""
+        self.ser.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def parse_gpsacp(self, AT_response):
         """Parse the results of AT$GPSACP."""
-        if AT_response != (",,,,,0,,,,," or ",,,,,1,,,,,"):
-            gnss_values = AT_response.replace("$GPSACP: ", "").split(sep=",")
-            # Process date
-            year = int("20" + gnss_values[9][4:6])
-            month = int(gnss_values[9][2:4])
-            day = int(gnss_values[9][0:2])
-            date = datetime.date(year, month, day).isoformat()
-            # Process UTC time
-            hour = int(gnss_values[0][0:2])
-            minute = int(gnss_values[0][2:4])
-            second = int(gnss_values[0][4:6])
-            time = datetime.time(hour, minute, second,
-                                     tzinfo=datetime.timezone.utc).strftime("%H:%M:%S")
-            # Process latitude
-            degrees = int(gnss_values[1][0:2])
-            minutes = int(gnss_values[1][2:4])
-            decimal_minutes = int(gnss_values[1][5:9])
-            # Convert latitude to decimal degrees format
-            lat = degrees + minutes/60 + decimal_minutes/10000/60
-            if gnss_values[1][-1] == "S":
-                lat *= -1
-            # Process longitude
-            degrees = int(gnss_values[2][0:3])
-            minutes = int(gnss_values[2][3:5])
-            decimal_minutes = int(gnss_values[2][6:10])
-            lon = degrees + minutes/60 + decimal_minutes/10000/60
-            if gnss_values[2][-1] == "W":
-                lon *= -1
+        if not _is_no_fix(AT_response):
+            gnss_values = AT_response.removeprefix("$GPSACP: ").split(sep=",")
+            # Process date (ddmmyy) and UTC time (hhmmss.sss) together
+            timestamp = datetime.datetime.strptime(gnss_values[9] + gnss_values[0].split(sep=".")[0],
+                                                   "%d%m%y%H%M%S")
+            date = timestamp.date().isoformat()
+            time = f"{timestamp.hour:02d}:{timestamp.minute:02d}:{timestamp.second:02d}"
+            # Convert latitude (ddmm.mmmmN) to decimal degrees format
+            lat = _HEMISPHERE_SIGN[gnss_values[1][-1]] * (int(gnss_values[1][0:2]) + float(gnss_values[1][2:9])/60)
+            # Convert longitude (dddmm.mmmmE) to decimal degrees format
+            lon = _HEMISPHERE_SIGN[gnss_values[2][-1]] * (int(gnss_values[2][0:3]) + float(gnss_values[2][3:10])/60)
         else:
             warnings.warn("No GNSS fix yet; falling back to network-provided date", ATCommandWarning)
             lat = "N/A"
@@ -185,20 +290,14 @@ class TelitME910G1(SixfabBaseHat):
             AT_response (str): The information response returned by AT+CCLK?; for
                 example: '+CCLK: "02/09/07,22:30:25"'
         """
-        modem_date_time = AT_response.replace("+CCLK: ", "").strip('"').split(sep=",")
-        # Process date
-        year = int("20" + modem_date_time[0][0:2])
-        month = int(modem_date_time[0][3:5])
-        day = int(modem_date_time[0][6:8])
-        date = datetime.date(year, month, day).isoformat()
+        # The time zone suffix (for example "+00"), if any, is ignored
+        modem_date_time = AT_response.removeprefix("+CCLK: ").strip('"')[:17]
         # Process time, assumed to be in UTC
         # Checking and setting modem time reporting to UTC should be done
         # outside of this function, which is purely a parser
-        hour = int(modem_date_time[1][0:2])
-        minute = int(modem_date_time[1][3:5])
-        second = int(modem_date_time[1][6:8])
-        time = datetime.time(hour, minute, second,
-                                 tzinfo=datetime.timezone.utc).strftime("%H:%M:%S")
+        timestamp = datetime.datetime.strptime(modem_date_time, "%y/%m/%d,%H:%M:%S")
+        date = timestamp.date().isoformat()
+        time = f"{timestamp.hour:02d}:{timestamp.minute:02d}:{timestamp.second:02d}"
 
         return date, time
 
@@ -221,44 +320,131 @@ class TelitME910G1(SixfabBaseHat):
             Code, and E-UTRAN Cell Identifier.
         """
         # Strip network survey started and ended lines
-        AT_response_lines = AT_response_lines[1:len(AT_response_lines) - 1]
+        AT_response_lines = AT_response_lines[1:-1]
         network_info_list = []
         for network in AT_response_lines:
-            # Use regex here since the some of the values can be padded with
-            # spaces, so str.split won't work.
-            # Also some of the values can either be in decimal or hexadecimal,
-            # hence the \w rather than \d
-            m = re.match(r'earfcn: (?: *)(\d{1,5}) rxLev: 0 mcc: (\d{3}) mnc: (\d{2,3}) (?:NBIoT)cellid: (?: *)(\w+) tac: (?: *      )(\w+) cellIdentity: (?: *)(\w+) rsrp: 0.00 rsrq: 0.00', flags=re.ASCII)
-            if "NBIoT" in m.group(0):
-                act = "NB-IoT"
-            else:
-                act = "LTE-M"
+            # Each line is a fixed sequence of "label: value" pairs, for
+            # example "earfcn: 5110 rxLev: 0 mcc: 310 mnc: 410 NBIoTcellid: 12
+            # tac: 2A01 cellIdentity: 0A1B2C rsrp: 0.00 rsrq: 0.00". Values can
+            # be padded with spaces, and are either decimal or hexadecimal.
+            # The NBIoT marker is glued to the cellid label.
+            act = "NB-IoT" if "NBIoTcellid:" in network else "LTE-M"
+            tokens = network.replace("NBIoTcellid:", "cellid:").split()
+            values = dict(zip(tokens[0::2], tokens[1::2]))
             network_info_list.append({
-                "EARFCN": m.group(1),
-                "MCC": m.group(2),
-                "MNC": m.group(3),
+                "EARFCN": values["earfcn:"],
+                "MCC": values["mcc:"],
+                "MNC": values["mnc:"],
                 "ACT": act,
-                "PCI": m.group(4),
-                "TAC": m.group(5),
-                "ECI": m.group(6)
+                "PCI": values["cellid:"],
+                "TAC": values["tac:"],
+                "ECI": values["cellIdentity:"]
                 })
 
         return network_info_list
 
     def await_urc(self, timeout=3, wait=0.1):
+        self._ensure_open()
         old_timeout = self.ser.timeout
         self.ser.timeout = timeout
-        # hint is 5 so that it can capture '\r\nOK\r\n' but nothing longer
-        URC = self.sio.readlines(5)[1].strip('\r\n')
+        # URCs are preceded by an empty line. The size cap keeps a garbled
+        # line from blocking the read for longer than the timeout.
+        URC = self.ser.read_until(b"\r\n", size=128)
+        if URC == b"\r\n":
+            URC = self.ser.read_until(b"\r\n", size=128)
+        URC = URC.decode("ascii", "replace").strip('\r\n')
         self.ser.timeout = old_timeout
 
         if URC == '':
             warnings.warn('Timeout in waiting for URC', ModemWarning)
         return URC
 
-    def cmd_query(self, AT_commandline, timeout=None, wait=0.1, multiline=False):
-        # This method assumes the serial device is already opened via serial.Serial.open() method.
-        # Currently this is buggy with AT#HTTPRCV, due to delayed OK
+    @contextlib.contextmanager
+    def _led_on(self, enabled=True):
+        """Light the user LED for the duration of the with block.
+
+        Args:
+            enabled (bool): If False, leave the LED alone. Default True.
+        """
+        if not enabled:
+            yield
+            return
+        self.led = True
+        try:
+            yield
+        finally:
+            self.led = False
+
+    @contextlib.contextmanager
+    def _session(self):
+        """Make sure the serial port is open for the duration of the with
+        block.
+
+        The port is kept open for the lifetime of the object, to avoid
+        reconfiguring the tty (and toggling DTR) on every call. It is only
+        reopened here if it was closed, for example via close(); sessions can
+        be nested.
+        """
+        self._ensure_open()
+        yield self.ser
+
+    def _ensure_open(self):
+        """Reopen the serial port if it was closed, for example via close().
+
+        Every method which talks to the modem calls this first.
+        """
+        if not self.ser.is_open:
+            self.ser.open()
+            # The setting does not survive closing the port
+            self._set_low_latency_mode()
+
+    def _set_low_latency_mode(self):
+        """Ask the serial driver not to hold back short reads.
+
+        By default, USB serial drivers may hold back short reads for up to
+        16 ms, which adds to every AT command round trip. Not all drivers
+        support this, and it is only available on Linux.
+        """
+        try:
+            self.ser.set_low_latency_mode(True)
+        except (AttributeError, ValueError):
+            logger.debug("could not set low latency mode on %s", self.chardev)
+
+    def _command_guard(self, guard):
+        """Wait until guard seconds have passed since the last response.
+
+        Telit recommends waiting 20ms between commands. Time already spent
+        since the previous response was received counts towards this, so
+        back-to-back commands are not delayed by the full guard time.
+        """
+        remaining = self._last_response_time + guard - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def _read_response(self):
+        """Read from the modem up to and including the final result code.
+
+        Everything waiting in the serial buffer is read at once; when it is
+        empty, the read blocks until a byte arrives or the serial timeout
+        passes. The response is returned as soon as the result code arrives.
+        Waits indefinitely for the start of the response; after that, gives up
+        if the serial timeout passes without any new bytes.
+
+        Returns:
+            The bytes read from the modem.
+        """
+        response = bytearray()
+        while True:
+            chunk = self.ser.read(self.ser.in_waiting or 1)
+            response += chunk
+            if not chunk and response:
+                return bytes(response)
+            # Result codes (even verbose error ones) are well under 256 bytes
+            if response.endswith(b"\r\n") and _RESULT_CODE_RE.search(response, max(0, len(response) - 256)):
+                self._last_response_time = time.monotonic()
+                return bytes(response)
+
+    def cmd_query(self, AT_commandline, timeout=None, wait=0.1, multiline=False, no_led=False):
         """Send an AT command, and receive a response.
 
         Args:
@@ -267,93 +453,75 @@ class TelitME910G1(SixfabBaseHat):
                 example, AT+CREG=1;+COPS=0.
             timeout (float): Temporary override for the serial device timeout,
                 in seconds. Default None.
-            wait (float): How long to wait, in seconds, until checking the
-                serial buffer for new bytes when expecting a response. Default
-                0.1.
+            wait (float): Unused; the response is read with blocking reads.
+                Kept for backwards compatibility.
             multiline (bool): Whether the response will contain multiple lines
                 (excluding result codes). If True, the return type will be an
                 array of lines. Default False.
+            no_led (bool): If True, do not light the user LED while waiting for
+                the response; useful in polling loops. Default False.
 
         Returns: Either a string containing the data response (if no data, it
             is the empty string) or an array of strings representing a line in
             the response, if multiline was True.
 
-        Write about custom return for AT#HTTPRCV
+            For AT#HTTPRCV, the received HTTP response body is returned as a
+            single string.
         """
-        # Set read timeout override
-        if timeout:
-            old_timeout = self.ser.timeout
-            setattr(self.ser, "timeout", timeout)
+        # The port is kept open from __init__ onwards, but may have been
+        # closed since
+        self._ensure_open()
+        # Discard leftover bytes, such as URCs, so they are not mistaken for
+        # the response; flushing an empty buffer is as cheap as checking it
+        self.ser.reset_input_buffer()
+        self._command_guard(0.02)
+        self.ser.write(_encode_commandline(AT_commandline))
 
-        if self.ser.in_waiting != 0:
-            self.ser.reset_input_buffer()
-        # Telit recommends waiting 20ms between commands
-        time.sleep(0.02)
-        self.sio.write(AT_commandline+"\r")
+        # Set read timeout override
+        old_timeout = self.ser.timeout
+        self.ser.timeout = timeout or old_timeout
+        try:
+            # User LED indicates waiting for AT response
+            with self._led_on(not no_led):
+                response = self._read_response().decode("ascii", "replace")
+        finally:
+            # Restore original timeout
+            self.ser.timeout = old_timeout
 
-        # User LED indicates waiting for AT response
-        self.led = True
-        while self.ser.in_waiting == 0:
-            time.sleep(wait)
-        self.led = False
-
-        response_lines = []
-        print("DEBUG serial buffer has", self.ser.in_waiting, "bytes in waiting")
-        response_lines = self.sio.readlines()
-        print("DEBUG read all lines in serial buffer")
-        print("DEBUG serial buffer has", self.ser.in_waiting, "bytes in waiting")
-        print("DEBUG BufferedRWPair buffer has", len(self.sio.buffer.peek()), "bytes in waiting")
-        print("DEBUG the lines read are", response_lines)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("the bytes read are %r", response)
 
         # Custom parsing for HTTP responses
         if AT_commandline.upper().startswith('AT#HTTPRCV'):
-            old_timeout = self.ser.timeout
-            self.ser.timeout = 0.5
-            # Check for '\r\nOK\r\n'
-            # hint is 5; will read '\r\n' and then '\r\nOK' making total size 6, which exceeds 5
-            result_code = ''.join(self.sio.readlines(5)).replace('\r\n', '')
-            self.ser.timeout = old_timeout
+            http_response, _, result_code = response.removesuffix("\r\n").rpartition("\r\n")
             if result_code == "OK":
-                http_response = ''.join(response_lines)
-                # For some reason not working?
-                #http_response = http_response.removeprefix('\r\n>>>')
-                http_response = http_response[5:]
-                return http_response
-            elif "ERROR" in result_code:
+                # Strip the leading '\r\n<<<'
+                return http_response[5:]
+            elif result_code.startswith(_ERROR_PREFIXES):
                 raise ATCommandError(f'Command "{AT_commandline}" returned result code "{result_code}"')
 
-        for line in response_lines:
-            if line in {'\r\n', ''}:
-                response_lines.remove(line)
-        # I tried doing this in a single for loop, and did not get desired
-        # result.
-        for line in response_lines:
-            if '\r\n' in line:
-                response_lines[response_lines.index(line)] = line.strip('\r\n')
-        print("DEBUG processed response lines is now", response_lines)
+        response_lines = [line.translate(_CRLF_STRIP) for line in response.split("\r\n")
+                          if line and not line.isspace()]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("processed response lines is now %s", response_lines)
 
         # Error checking
-        result_code = response_lines.pop()
-        if "OK" in result_code:
+        result_code = response_lines.pop() if response_lines else ""
+        if result_code == "OK":
             pass
-        elif "ERROR" in result_code:
+        elif result_code.startswith(_ERROR_PREFIXES):
             raise ATCommandError(f'Command "{AT_commandline}" returned result code "{result_code}"')
         # NO CARRIER appears to be used by Telit to signal when a socket is
         # closed Also, AT#SGACTCFGEXT has an option to enable sending 1 byte
         # before AT#SGACT=n,1 completes, to abort PDP context activation. NO
         # CARRIER is sent as confirmation.
-        elif "NO CARRIER" in result_code:
+        elif result_code == "NO CARRIER":
             raise ATCommandError(f'Command "{AT_commandline}" returned "NO CARRIER"')
         # I don't think I've ever seen this one
         #elif "CONNECT" in result_code:
         #    pass
         else:
-            raise ModemError('No result code detected for "{AT_commandline}", or there was an error reading it')
-
-        # Restore original timeout
-        #TODO this doesnt seem to work
-        if timeout:
-            setattr(self.ser, "timeout", old_timeout)
+            raise ModemError(f'No result code detected for "{AT_commandline}", or there was an error reading it')
 
         if multiline:
             return response_lines
@@ -362,6 +530,49 @@ class TelitME910G1(SixfabBaseHat):
         else:
             return ''
 
+    def _cached_query(self, AT_commandline, ttl=1.0):
+        """Like cmd_query, but reuse a response received less than ttl seconds
+        ago.
+
+        Only use this for queries which do not change the state of the modem,
+        such as AT#RFSTS.
+        """
+        now = time.monotonic()
+        cached = self._at_cache.get(AT_commandline)
+        if cached is not None and now - cached[0] < ttl:
+            return cached[1]
+        response = self.cmd_query(AT_commandline)
+        self._at_cache[AT_commandline] = (now, response)
+        return response
+
+    def cmd_query_batch(self, AT_commands, timeout=None):
+        """Send several AT commands in one commandline, and receive a response.
+
+        This saves the round trip to the modem for each command after the
+        first one.
+
+        Args:
+            AT_commands (list|tuple): The AT commands to send, each beginning
+                with "AT", for example ("AT#QSS?", "AT$GPSP?"). These are
+                joined with ";" into a single commandline, so they must be
+                extended commands (or a bare "AT").
+            timeout (float): Temporary override for the serial device timeout,
+                in seconds. Default None.
+
+        Returns: A list with the information response line of each command, in
+            the same order as AT_commands. The response to a command is the
+            line beginning with the name of the command (for example
+            "#QSS: 0,1" for AT#QSS?), or the empty string if there is none.
+        """
+        response_lines = self.cmd_query("AT" + ";".join(command[2:] for command in AT_commands if command[2:]),
+                                         timeout=timeout, multiline=True)
+        responses = []
+        for command in AT_commands:
+            name = re.split(r"[=?]", command[2:], maxsplit=1)[0]
+            responses.append(next((line for line in response_lines if name and line.startswith(name + ":")), ""))
+
+        return responses
+
     def one_time_setup(self):
         """One-time configuration.
 
@@ -433,17 +644,8 @@ class TelitME910G1(SixfabBaseHat):
             pdp_cid (int|str): ID of the PDP context (1 to modem-specific
                 maximum number) to use for this HTTP context; default 1.
         """
-        self.cmd_query(f"AT#HTTPCFG="
-                       f"{http_prof_id},"
-                       f"{server_address},"
-                       f"{server_port},"
-                       # No HTTP authentication, username, password, or SSL.
-                       '0,"","",0,'
-                       f"{http_response_timeout},"
-                       f"{pdp_cid},"
-                       f"{pkt_size},"
-                       "0,0",
-                       )
+        self.cmd_query(self._HTTPCFG.format(http_prof_id, server_address, server_port,
+                                            http_response_timeout, pdp_cid, pkt_size))
 
     def http_send(self, resource, data, http_prof_id=0, request_type="POST", post_param=1, wait=0.1):
         """Send an HTTP request to a remote endpoint.
@@ -453,80 +655,111 @@ class TelitME910G1(SixfabBaseHat):
                 always begin with "/"; for example, to send to
                 "www.foo.bar/api/intake", resource should be set to
                 "/api/intake".
-            data (str): The data to send in the body of the request. Currently
-                the type must be str.
+            data (str|bytes): The data to send in the body of the request.
+                A str must be ASCII.
             http_prof_id (int|str): The numeric identifier (from 0 to 2) of the
                 HTTP context to use; default 0. These are stored on the modem
                 non-volatile memory.
             request_type (str): Either "POST" or "PUT".
             post_param (str): The HTTP Content-type; defaults to
             "application/x-www-form-urlencoded". Only use with POST requests.
-            wait (float):
+            wait (float): Unused; the response is read with blocking reads.
+                Kept for backwards compatibility.
 
         """
-        match request_type.upper():
-            case "POST":
-                command = 0
-            case "PUT":
-                command = 1
-            case _:
-                raise RuntimeError("Unsupported request_type")
-
-        if command == 0:
-            HTTP_AT_command = "AT#HTTPSND=" \
-                              f"{http_prof_id}," \
-                              f"{command}," \
-                              f"{resource}," \
-                              f"{len(data)}"
-        elif command == 1:
-            HTTP_AT_command = "AT#HTTPSND=" \
-                              f"{http_prof_id}," \
-                              f"{command}," \
-                              f"{resource}," \
-                              f"{len(data)}," \
-                              f"{post_param}"
-
-        print("DEBUG about to send:", HTTP_AT_command)
-
-        # Just like self.cmd_query, the serial device needs to be opened by
-        # a higher level piece of code
-        if self.ser.in_waiting != 0:
-            self.ser.reset_input_buffer()
-
-        time.sleep(0.05)
-        self.sio.write(HTTP_AT_command+"\r")
+        template = self._HTTPSND.get(request_type.upper())
+        if template is None:
+            raise RuntimeError("Unsupported request_type")
+        # Unused fields are ignored by str.format
+        HTTP_AT_command = template.format(http_prof_id, resource, len(data), post_param)
 
-        self.led = True
-        while self.ser.in_waiting == 0:
-            time.sleep(0.1)
-        self.led = False
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("about to send: %s", HTTP_AT_command)
+
+        # Just like self.cmd_query, reopen the serial device if needed
+        self._ensure_open()
+        self.ser.reset_input_buffer()
+
+        self._command_guard(0.05)
+        self.ser.write((HTTP_AT_command+"\r").encode("ascii"))
 
         try:
-            # Should be "\r\n>>>"
-            ready_for_data_entry = self.sio.read(5)
+            with self._led_on():
+                # Should be "\r\n>>>"; block until the prompt arrives
+                ready_for_data_entry = b""
+                while not ready_for_data_entry.endswith(b">>>"):
+                    chunk = self.ser.read_until(b">>>", size=16)
+                    ready_for_data_entry += chunk
+                    if not chunk and ready_for_data_entry:
+                        break
+            ready_for_data_entry = ready_for_data_entry.decode("ascii", "replace")
         except serial.SerialException:
             raise serial.SerialException("Failed to read from serial input buffer; expected \">>>\" (ready for data entry for HTTP request)")
 
-        print("DEBUG ready_for_data_entry is", "'" + ready_for_data_entry.replace('\r\n', '\\r\\n') + "'")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("ready_for_data_entry is %r", ready_for_data_entry)
 
-        if ready_for_data_entry != "\r\n>>>":
-            raise ModemError(f"Modem returned {ready_for_data_entry} when \"\\r\\n>>>\" was expected")
+        # Match on the prompt itself, as a stray blank line may precede it
+        if not ready_for_data_entry.endswith(">>>"):
+            raise ModemError(f"Modem returned {ready_for_data_entry!r} when \"\\r\\n>>>\" was expected")
         else:
-            self.sio.write(data)
-            self.sio.flush()
-
-            self.led = True
-            while self.ser.in_waiting == 0:
-                time.sleep(wait)
-            self.led = False
-            # Check for <CR><LF>OK<CR><LF>
-            result_code = self.sio.readlines(5)
-            print("DEBUG result code after AT#HTTPSND is", result_code)
-            if "OK\r\n" not in result_code:
+            self.ser.write(data.encode("ascii") if isinstance(data, str) else data)
+            self.ser.flush()
+
+            with self._led_on():
+                # Check for <CR><LF>OK<CR><LF>
+                result_code = self._read_response()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("result code after AT#HTTPSND is %r", result_code)
+            if not result_code.endswith(b"\r\nOK\r\n"):
                 raise ATCommandError(f"Modem returned error after attempting to send HTTP data: {result_code}")
 
             return
 
+    def http_receive(self, length, http_prof_id=0):
+        """Read the body of an HTTP response received by the modem.
+
+        Unlike cmd_query("AT#HTTPRCV=..."), the body is read as raw bytes of
+        known length, so it is not split into lines and can contain anything.
+
+        Args:
+            length (int|str): The length of the response body in bytes, as
+                reported in the #HTTPRING URC.
+            http_prof_id (int|str): The numeric identifier (from 0 to 2) of the
+                HTTP context the response was received on; default 0.
+
+        Returns: The response body, as bytes.
+        """
+        length = int(length)
+        self._ensure_open()
+        self.ser.reset_input_buffer()
+        self._command_guard(0.02)
+        self.ser.write(f"AT#HTTPRCV={http_prof_id}\r".encode("ascii"))
+
+        with self._led_on():
+            # The body is preceded by "\r\n<<<"
+            prompt = self.ser.read_until(b"<<<")
+            while not prompt.endswith(b"<<<"):
+                if prompt.endswith(b"\r\n") and b"ERROR" in prompt:
+                    raise ATCommandError(f'Command "AT#HTTPRCV={http_prof_id}" returned result code "{prompt.decode("ascii", "replace").strip()}"')
+                chunk = self.ser.read_until(b"<<<")
+                if not chunk and prompt:
+                    raise ModemError(f"Modem returned {prompt} when \"<<<\" was expected")
+                prompt += chunk
+
+            body = bytearray()
+            while len(body) < length:
+                chunk = self.ser.read(length - len(body))
+                if not chunk:
+                    raise ModemError(f"Timeout after receiving {len(body)} of {length} bytes of HTTP response")
+                body += chunk
+            result_code = self._read_response()
+
+        if not result_code.endswith(b"\r\nOK\r\n"):
+            raise ATCommandError(f"Modem returned error after receiving HTTP data: {result_code}")
+
+        return bytes(body)
+
     def self_test(self):
         """Check if the modem is responding to AT commands and more.
 
@@ -534,12 +767,10 @@ class TelitME910G1(SixfabBaseHat):
         GPS module is powered, and which LTE UE category is in use. There
         should be no commands in this routine which require SIM presence.
         """
-        # serial.Serial has a context manager :)
-        with self.ser:
-            self.cmd_query("AT")
-
-            # query sim status
-            sim_status = self.cmd_query("AT#QSS?")[-1]
+        with self._session():
+            # query sim status and GPS power in the same commandline
+            _, sim_status, gps_power = self.cmd_query_batch(("AT", "AT#QSS?", "AT$GPSP?"))
+            sim_status = sim_status[-1]
 
             # match statement was added in python 3.10
             match sim_status:
@@ -553,8 +784,7 @@ class TelitME910G1(SixfabBaseHat):
                     print("SIM is ready")
 
             # GPS power
-            gps_power = self.cmd_query("AT$GPSP?")[-1]
-            match gps_power:
+            match gps_power[-1]:
                 case "0":
                     print("GNSS controller powered off")
                 case "1":
@@ -568,19 +798,40 @@ class TelitME910G1(SixfabBaseHat):
                 before giving up.
             interval (float): The time in seconds to wait between each query
                 for the GNSS fix.
+
+        Returns: The AT$GPSACP response once there is a fix, which can be
+            passed to parse_gpsacp, or None if no fix was acquired.
         """
-        with self.ser:
+        with self._session():
             if self.cmd_query("AT$GPSP?")[-1] == "0":
                 self.cmd_query("AT$GPSP=1")
-            i = 1
-            while self.cmd_query("AT$GPSACP") in {"$GPSACP: ,,,,,0,,,,,", "$GPSACP: ,,,,,1,,,,,"}:
-                if i > tries:
-                    raise RuntimeWarning(f"Could not acquire GNSS fix in {tries} tries ({tries*interval} seconds)")
-                    #warnings.warn(f"Could not acquire GNSS fix in {tries} tries ({tries*interval} seconds)", RuntimeWarning)
-                    break
+            for i in range(1, tries+1):
+                gpsacp = self.cmd_query("AT$GPSACP", no_led=True)
+                if not _is_no_fix(gpsacp):
+                    return gpsacp
                 print(f"GNSS fix attempt: {i}")
                 time.sleep(interval)
-                i += 1
+
+        warnings.warn(f"Could not acquire GNSS fix in {tries} tries ({tries*interval} seconds)", ATCommandWarning)
+        return None
+
+    async def await_gnss_async(self, tries=10, interval=1):
+        """Turn on the GNSS unit and await a fix, as a coroutine.
+
+        This runs await_gnss in a worker thread, so other tasks on the event
+        loop (for example sensor sampling) can run in the meantime. Nothing
+        else should use the modem until it is done.
+
+        Args:
+            tries (int): The number of times to query the GNSS unit for a fix
+                before giving up.
+            interval (float): The time in seconds to wait between each query
+                for the GNSS fix.
+
+        Returns: The AT$GPSACP response once there is a fix, which can be
+            passed to parse_gpsacp, or None if no fix was acquired.
+        """
+        return await asyncio.to_thread(self.await_gnss, tries, interval)
 
     def sim_test(self):
         """Show results of various SIM-required AT commands.
@@ -589,9 +840,10 @@ class TelitME910G1(SixfabBaseHat):
         . There should be no commands in this routine which require network
         registration.
         """
-        with self.ser:
+        with self._session():
+            ws46, creg, cops = self.cmd_query_batch(("AT#WS46?", "AT+CREG?", "AT+COPS?"))
             # IoT technology (NB-IoT or M1)
-            technology = self.cmd_query("AT#WS46?")[-3]
+            technology = ws46[-3]
             match technology:
                 case "0":
                     print("LTE mode is CAT-M1")
@@ -603,7 +855,7 @@ class TelitME910G1(SixfabBaseHat):
                     print("LTE mode is CAT-M1 and NB-IoT (preferred)")
 
             # Network registration status
-            regstat = self.cmd_query("AT+CREG?")[-1]
+            regstat = creg[-1]
             match regstat:
                 case "0":
                     print("Not registered, not searching for operator")
@@ -619,7 +871,7 @@ class TelitME910G1(SixfabBaseHat):
                     print("Registered, roaming")
 
             # Selected operator
-            cops_values = self.cmd_query("AT+COPS?").replace("+COPS: ", "").split(sep=",")
+            cops_values = cops.removeprefix("+COPS: ").split(sep=",")
             cops_mode = cops_values[0]
             match cops_mode:
                 case "0":
@@ -638,31 +890,53 @@ class TelitME910G1(SixfabBaseHat):
                 cops_format = cops_values[1]
                 cops_oper = cops_values[2]
                 cops_act = cops_values[3]
-                match cops_act:
-                    case "0":
-                        cops_act_human_readable = "GSM"
-                    case "8":
-                        cops_act_human_readable = "CAT M-1"
-                    case "9":
-                        cops_act_human_readable = "NB-IoT"
+                # Unknown access technologies are shown as their number
+                cops_act_human_readable = self._COPS_ACT.get(cops_act, cops_act)
                 print(f"Selected operator is {cops_oper} on mode {cops_act_human_readable}")
 
-    def signal_test(self):
+    def signal_test(self, max_age=1.0):
         """Get signal quality statistics.
 
         This method assumes that the modem is already registered on a cellular
         network.
+
+        Args:
+            max_age (float): Reuse statistics queried less than this many
+                seconds ago; default 1.0.
         """
-        with self.ser:
-            rfsts = self.cmd_query("AT#RFSTS")
-
-            # Check if modem is registered on a network
-            if self.cmd_query("AT+COPS?").count(",") != 0:
-                sstats = rfsts.replace("#RFSTS: ", "").split(sep=",")
-                return {"plmn": sstats[0].strip('"'), "earfcn": sstats[1], "rsrp": sstats[2],
-                        "rssi": sstats[3], "rsrq": sstats[4], "tac": sstats[5],
-                        "rac": sstats[6], "cellid": sstats[11], "imsi": sstats[12].strip('"'),
-                        "opname": sstats[13].strip('"'), "abnd": sstats[15], "sinr":
-                        sstats[18]}
-            else:
-                warnings.warn("Modem is not registered on a network", RuntimeWarning)
+        with self._session():
+            rfsts = self._cached_query("AT#RFSTS", ttl=max_age)
+
+        # Check if modem is registered on a network; if not, the PLMN is
+        # empty (or zero) and the other fields are missing
+        rfsts_match = _RFSTS_RE.match(rfsts)
+        if rfsts_match is not None and rfsts_match[1] not in ("", "0"):
+            signal_statistics = dict(zip(_RFSTS_KEYS, rfsts_match.groups()))
+            signal_statistics["opname"] = signal_statistics["opname"].strip('"')
+            return signal_statistics
+        else:
+            # Polling loops would otherwise repeat this on every call
+            now = time.monotonic()
+            if self._unregistered_logged_at is None or now - self._unregistered_logged_at >= 5:
+                self._unregistered_logged_at = now
+                logger.warning("Modem is not registered on a network")
+
+    def signal_test_batch(self, n, interval=1.0):
+        """Get n samples of signal quality statistics, interval seconds apart.
+
+        The serial port is kept open for the whole batch, and the samples are
+        started on a fixed cadence regardless of how long each one takes.
+
+        Returns: A list of n results of signal_test; a result is None if the
+            modem was not registered on a network at the time.
+        """
+        samples = [None] * n
+        with self._session():
+            deadline = time.monotonic()
+            for i in range(n):
+                samples[i] = self.signal_test(max_age=0)
+                if i < n - 1:
+                    deadline += interval
+                    time.sleep(max(0, deadline - time.monotonic()))
+
+        return samples
@@ -1,4 +1,5 @@
 import lgpio
+import struct
 import time
 import warnings
 
@@ -15,6 +16,9 @@ SHTC3_CMD_LPCS_READ_HT = b'\x44\xde'
 SHTC3_CMD_READ_ID_REGISTER = b'\xef\xc8'
 SHTC3_CMD_SOFTWARE_RESET = b'\x80\x5d'
 
+# A SHTC3 measurement: big-endian temperature word, its CRC, humidity word, its CRC
+SHTC3_MEASUREMENT = struct.Struct(">HBHB")
+
 LPS22HB_REG_CTRL_1 = 0x10
 LPS22HB_REG_CTRL_2 = 0x11
 LPS22HB_REG_CTRL_3 = 0x12
@@ -24,6 +28,20 @@ LPS22HB_REG_PRESS_OUT_L = 0x29
 LPS22HB_REG_PRESS_OUT_H = 0x2A
 LPS22HB_REG_TEMP_OUT_L = 0x2B
 LPS22HB_REG_TEMP_OUT_H = 0x2C
+# Bits which the sensor clears by itself once done: BOOT, SWRESET and ONE_SHOT
+LPS22HB_CTRL_2_SELF_CLEARING = 0b10000101
+
+def _crc8_table_entry(byte):
+    crc = byte
+    for _ in range(8):
+        if crc & 0x80:
+            crc = ((crc << 1) ^ 0x31) & 0xff
+        else:
+            crc = (crc << 1) & 0xff
+    return crc
+
+# CRC-8 (polynomial 0x31) of every byte value, used by SHTC3._crc_check
+_CRC8_TABLE = bytes(_crc8_table_entry(byte) for byte in range(256))
 
 class SHTC3:
     def __init__(self):
@@ -39,20 +57,16 @@ class SHTC3:
     def _crc_check(self, data_bytes, checksum):
         """Check if the provided data matches a CRC checksum.
         Args:
-            data_bytes (bytes): The bytes to perform the CRC check on.
+            data_bytes (bytes|memoryview): The bytes to perform the CRC check on.
             checksum (int): Unsigned big-endian CRC checksum to check against.
 
         """
         # Ideally this function would be using a CRC library to maintain readability, but at the time of writing this machine does not have internet access to install said library.
+        # The bit-by-bit division of each byte is precomputed in _CRC8_TABLE
         crc = 0xff
         for byte in data_bytes:
-            crc ^= byte
-            for _ in range(8):
-                if crc & 0x80:
-                    crc = ((crc <<1) ^ 0x31) & 0xff
-                else:
-                    crc = (crc << 1) & 0xff
-        return True if crc ^ 0x00 == checksum else False
+            crc = _CRC8_TABLE[crc ^ byte]
+        return crc == checksum
 
     def write_command(self, word, delay=0.01):
         """Write a byte to an I2C address.
@@ -77,25 +91,28 @@ class SHTC3:
         return response
 
     def get_temperature_humidity(self, do_crc=True):
-        self.write_command(SHTC3_CMD_WAKEUP)
-        self.write_command(SHTC3_CMD_READ_TH)
+        # Delays are the datasheet maxima: 240 us to wake up, and 12.1 ms for
+        # a normal mode measurement. Clock stretching is not used, as the
+        # Raspberry Pi I2C controller does not handle it reliably.
+        self.write_command(SHTC3_CMD_WAKEUP, delay=0)
+        self.write_command(SHTC3_CMD_READ_TH, delay=0.001)
         # Expect 6 bytes
-        th_response = self.read_bytes(6, delay=0.05)
-        self.write_command(SHTC3_CMD_SLEEP)
+        th_response = self.read_bytes(6, delay=0.013)
+        self.write_command(SHTC3_CMD_SLEEP, delay=0)
+        t_raw, t_checksum, rh_raw, rh_checksum = SHTC3_MEASUREMENT.unpack(th_response)
+        # Slices of a memoryview do not copy the data words
+        th_view = memoryview(th_response)
+        # The scale factors are folded into constants at compile time
+        temperature_celsius = -45 + t_raw * (175 / 2**16)
+        relative_humidity_percent = rh_raw * (100 / 2**16)
         if do_crc:
-            temperature_celsius = -45 + 175 * int.from_bytes(th_response[0:2]) / 2**16
-            relative_humidity_percent = 100 * int.from_bytes(th_response[3:5]) / 2**16
-
-            if not self._crc_check(th_response[0:2], th_response[2]):
+            if not self._crc_check(th_view[0:2], t_checksum):
                 # Perhaps log this to syslog or something?
                 warnings.warn("CRC check failed for temperature", RuntimeWarning)
                 temperature_celsius = None
-            if not self._crc_check(th_response[3:5], th_response[5]):
+            if not self._crc_check(th_view[3:5], rh_checksum):
                 warnings.warn("CRC check failed for relative humidity", RuntimeWarning)
                 relative_humidity_percent = None
-        else:
-            temperature_celsius = -45 + 175 * int.from_bytes(th_response[0:2]) / 2**16
-            relative_humidity_percent = 100 * int.from_bytes(th_response[3:5]) / 2**16
 
         return temperature_celsius, relative_humidity_percent
 
@@ -103,34 +120,45 @@ class LPS22HB:
     def __init__(self):
         # I2C address is hardcoded to 0x5c for this sensor
         self.handle = lgpio.i2c_open(1, 0x5c)
+        # Last known values of the control registers, which only change when
+        # written to (apart from self-clearing bits)
+        self._registers = {}
 
     def update_register(self, reg, bitmask):
         """
 
+        Only the first update of a register reads it from the sensor; after
+        that its value is known.
+
         Args:
             reg (int): The register to update.
             bitmask (int): A byte with which the old register value is OR'ed
                 with. The bits that are 1 in the bitmask will be set to 1 in the
                 register.
         """
-        old_value = lgpio.i2c_read_byte_data(self.handle, reg)
+        old_value = self._registers.get(reg)
+        if old_value is None:
+            old_value = lgpio.i2c_read_byte_data(self.handle, reg)
         new_value = old_value | bitmask
         lgpio.i2c_write_byte_data(self.handle, reg, new_value)
+        if reg == LPS22HB_REG_CTRL_2:
+            new_value &= ~LPS22HB_CTRL_2_SELF_CLEARING
+        self._registers[reg] = new_value
 
-    def get_pressure(self, attempts=10):
+    def get_pressure(self, attempts=100):
         # Set last bit of control register 2 to 1, to begin a oneshot acquisition
         self.update_register(LPS22HB_REG_CTRL_2, 0b00000001)
         # Check if new pressure data is available; indicated by bit 0
+        # A oneshot acquisition takes a few ms, so poll every 1 ms (up to 100 ms by default)
         _attempt = 1
-        while (lgpio.i2c_read_byte_data(self.handle, LPS22HB_REG_STATUS ) & 0b00000001 == 0) and _attempt <= attempts:
-            time.sleep(0.01)
+        while not (status := lgpio.i2c_read_byte_data(self.handle, LPS22HB_REG_STATUS)) & 0b00000001 and _attempt <= attempts:
+            time.sleep(0.001)
             _attempt += 1
-        if lgpio.i2c_read_byte_data(self.handle, LPS22HB_REG_STATUS) & 0b00000001 == 1:
+        if status & 0b00000001 == 1:
             # Pressure is 3 bytes, stored as 2's complement, expressed as 4096 times the pressure in hPa
-            pressure_lsb = lgpio.i2c_read_byte_data(self.handle, LPS22HB_REG_PRESS_OUT_XL)
-            pressure_mid = lgpio.i2c_read_byte_data(self.handle, LPS22HB_REG_PRESS_OUT_L)
-            pressure_msb = lgpio.i2c_read_byte_data(self.handle, LPS22HB_REG_PRESS_OUT_H)
-            pressure_hpa = ((pressure_msb << 16) + (pressure_mid << 8) + pressure_lsb) / 4096
+            # Register addresses auto-increment (IF_ADD_INC in control register 2 is set by default), so all 3 bytes are read in one transaction
+            _, pressure_bytes = lgpio.i2c_read_i2c_block_data(self.handle, LPS22HB_REG_PRESS_OUT_XL, 3)
+            pressure_hpa = int.from_bytes(pressure_bytes, "little", signed=True) / 4096
         else:
             warnings.warn("Could not retrieve pressure data in time", RuntimeWarning)
             pressure_hpa = None
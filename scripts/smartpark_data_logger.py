@@ -3,10 +3,13 @@
 import csv
 import datetime
 import grp
-import json
 import os
 import pwd
+import queue
+import signal
 import subprocess
+import sys
+import threading
 import time
 import warnings
 
@@ -25,13 +28,23 @@ break_time = 60
 unix_username = "PUT UNIX USERNAME HERE"
 # Cannot use ~ expansion due to systemd not initializing HOME environment
 # variable
-csv_file_path = os.path.join(pwd.getpwnam(unix_username).pw_dir, "sensor_reading_history.csv")
+unix_user = pwd.getpwnam(unix_username)
+csv_file_path = os.path.join(unix_user.pw_dir, "sensor_reading_history.csv")
 # Either a domain name or IP address
 website_address = "PUT_ADDRESS_HERE"
 website_port = 80
 # The resource to send to on the HTTP server
 # For example, /api/sensordata
 website_endpoint = "PUT ENDPOINT HERE"
+# Number of readings to buffer before writing them to the csv file; readings
+# not yet written are lost if the device loses power, but stopping the service
+# writes them
+csv_flush_interval = 4
+# Number of readings to send in each HTTP request. With 1, each request is
+# {"d": ..., "t": ..., "h": ..., "p": ...}; with more, the readings are sent
+# together as {"d": ..., "r": [{"t": ..., "h": ..., "p": ...}, ...]}, which
+# saves the per-request modem and cellular overhead
+upload_batch_size = 1
 
 SHTC3_sensor = sensors.SHTC3()
 LPS22HB_sensor = sensors.LPS22HB()
@@ -41,34 +54,38 @@ modem = csq.TelitME910G1()
 csv_fields = ("Date (mm/dd/yy)", "Time (UTC)", "Temperature (°C)", "Relative Humidity (%)", "Pressure (hPa)")
 with open("/etc/hostname", "r") as file:
     hostname = file.readline().strip("\r\n")
+# We set the last character of our device hostname to be a numeric identifier for the device
+device_id = int(hostname[-1])
+# JSON is built from templates, as the shape is fixed and the values are
+# rounded floats (whose str() is valid JSON). Using one-letter variable names,
+# and no whitespace, minimize size of data being transmitted
+reading_json_template = '"t":{},"h":{},"p":{}'
+# Filled with the device id and one reading
+single_json_template = '{{"d":{},{}}}'
+# Filled with the device id and the readings joined by "},{"
+batch_json_template = '{{"d":{},"r":[{{{}}}]}}'
 
 # Modem configuration and time acquisition
-with modem.ser:
-    # Report time in UTC and enable time updates from mobile network
-    if modem.AT_query("AT#CCLKMODE?") != "#CCLKMODE: 1":
-        modem.AT_query("AT#CCLKMODE=1")
-    if modem.AT_query("AT+CTZU?") != "+CTZU: 1":
-        modem.AT_query("AT+CTZU=1")
-    cclk_response = modem.AT_query("AT+CCLK?").replace("+CCLK: ", "").strip('"')
-    print(f"Received date and time from modem: {cclk_response}")
-    modem.http_setup(server_address=website_address, server_port=website_port, pkt_size=100)
-    try:
-        modem.AT_query("AT#SGACT=1,1")
-    except csq.ATCommandError as ex:
-        if "context already activated" in ex.args[0]:
-            print('Tried to activate PDP context 1, but it is already activated')
-        else:
-            raise ex
-
-year = int(cclk_response[0:2])
-month = int(cclk_response[3:5])
-day = int(cclk_response[6:8])
-hour = int(cclk_response[9:11])
-minute = int(cclk_response[12:14])
-second = int(cclk_response[15:17])
-timedatectl_string = datetime.datetime(year, month, day, hour, minute, second, tzinfo=datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-
-# unix_timestamp = datetime.datetime(year, month, day, hour, minute, second, tzinfo=datetime.timezone.utc).timestamp()
+# Report time in UTC and enable time updates from mobile network. Setting
+# these is idempotent, so it is cheaper than querying them first
+modem.cmd_query("AT#CCLKMODE=1;+CTZU=1")
+cclk_response = modem.cmd_query("AT+CCLK?").removeprefix("+CCLK: ").strip('"')
+print(f"Received date and time from modem: {cclk_response}")
+modem.http_setup(server_address=website_address, server_port=website_port, pkt_size=100)
+try:
+    modem.cmd_query("AT#SGACT=1,1")
+except csq.ATCommandError as ex:
+    if "context already activated" in ex.args[0]:
+        print('Tried to activate PDP context 1, but it is already activated')
+    else:
+        raise ex
+
+# The time zone suffix (for example "+00"), if any, is ignored; the year has
+# two digits
+cclk_datetime = datetime.datetime.strptime(cclk_response[:17], "%y/%m/%d,%H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+timedatectl_string = cclk_datetime.strftime("%Y-%m-%d %H:%M:%S")
+
+# unix_timestamp = cclk_datetime.timestamp()
 # need root to do this
 # C library gives overflow error for July 2025 on pi zero 2 W; will need to use alternate method
 # time.clock_settime(time.CLOCK_REALTIME, unix_timestamp)
@@ -87,55 +104,132 @@ else:
 os.setgroups((grp.getgrnam("dialout").gr_gid,))
 # Drop root priveleges needed for setting the system time
 # This also ensures the csv file is accessible by the user
-os.setgid(pwd.getpwnam(unix_username).pw_gid)
-os.setuid(pwd.getpwnam(unix_username).pw_uid)
-
-with open(csv_file_path, mode="a", newline="") as csvfile:
-    print(f"Recording information to {csv_file_path}")
-    writer = csv.DictWriter(csvfile, csv_fields)
-    if os.stat(csv_file_path).st_size == 0:
-        writer.writeheader()
-
-while True:
-    time_struct = time.gmtime(time.time())
-    t_degrees_c, rh_percent = map(round, SHTC3_sensor.get_temperature_humidity(), (2,) * 2)
-    p_hpa = round(LPS22HB_sensor.get_pressure(), 2)
-    new_csv_row = {
-                    "Date (mm/dd/yy)": time.strftime("%m/%d/%Y", time_struct),
-                    "Time (UTC)": time.strftime("%H:%M:%S", time_struct),
-                    "Temperature (°C)": t_degrees_c,
-                    "Relative Humidity (%)": rh_percent,
-                    "Pressure (hPa)": p_hpa
-                  }
-    print(f"New sensor reading; T: {t_degrees_c} RH: {rh_percent} P: {p_hpa}")
-    with open(csv_file_path, mode="a", newline="") as csvfile:
-        writer = csv.DictWriter(csvfile, csv_fields)
-        writer.writerow(new_csv_row)
-    # Using one-letter variable names minimize size of data being transmitted
-    # We set the last character of our device hostname to be a numeric identifier for the device
-    json_data = json.dumps({"d": int(hostname[-1]), "t": t_degrees_c, "h": rh_percent, "p": p_hpa})
-    # If the send interval is low enough (ballpark 5 seconds), I would
-    # recommend keeping the serial device open instead of using the with
-    # statement, which opens and closes the device each pass of the loop
-    with modem.ser:
+os.setgid(unix_user.pw_gid)
+os.setuid(unix_user.pw_uid)
+
+
+def upload_reading(json_data):
+    """Send one JSON payload to the HTTP server, and wait for the response."""
+    # The modem keeps its serial device open between requests, rather
+    # than reopening it (and reconfiguring the tty) for each one
+    try:
+        modem.http_send(resource=website_endpoint, data=json_data, post_param="application/json")
+        print(f'Sent HTTP request to {website_address + website_endpoint}; waiting for HTTP response')
+    except csq.serial.SerialException as ex:
+        warnings.warn(f"SerialException occured in sending HTTP request, with arguments {ex.args}")
+    except csq.ModemError as ex:
+        warnings.warn(f"ModemError occured in sending HTTP request, with arguments {ex.args}")
+    except csq.ATCommandError as ex:
+        warnings.warn(f"ATCommandError occured in sending HTTP request, with arguments {ex.args}")
+
+    http_ring = modem.await_urc(timeout=15)
+    print(f'DEBUG got URC: {http_ring}')
+    # await_urc returns an empty string on timeout, and has already warned
+    # about it
+    if not http_ring:
+        return
+    http_response_metadata = http_ring.removeprefix('#HTTPRING: ').split(sep=',')
+    if len(http_response_metadata) < 4:
+        warnings.warn(f"Unexpected URC while waiting for HTTP response: {http_ring}")
+        return
+    if http_response_metadata[2] == '':
+        http_response_metadata[2] = '(not present)'
+    print(f'Received HTTP response on profile {http_response_metadata[0]}, status {http_response_metadata[1]}, content type {http_response_metadata[2]}, {http_response_metadata[3]} bytes')
+    if http_response_metadata[1] != '201':
+        print('HTTP response status is not OK (201); taking a break')
+        time.sleep(break_time)
+
+
+def upload_readings(uploads):
+    """Send the JSON readings from the queue to the HTTP server, one by one.
+
+    This runs in its own thread, so waiting on the modem (and taking a break
+    after an error response) does not hold up sensor readings.
+    """
+    while True:
+        json_data = uploads.get()
+        # Any error is limited to this payload; the thread must keep running
+        # for the lifetime of the service
         try:
-            modem.http_send(resource=website_endpoint, data=json_data, post_param="application/json")
-            print(f'Sent HTTP request to {website_address + website_endpoint}; waiting for HTTP response')
-        except csq.serial.SerialException as ex:
-            warnings.warn(f"SerialException occured in sending HTTP request, with arguments {ex.args}")
-        except csq.ModemError as ex:
-            warnings.warn(f"ModemError occured in sending HTTP request, with arguments {ex.args}")
-        except csq.ATCommandError as ex:
-            warnings.warn(f"ATCommandError occured in sending HTTP request, with arguments {ex.args}")
-
-        http_ring = modem.await_urc(timeout=15)
-        print(f'DEBUG got URC: {http_ring}')
-        http_response_metadata = http_ring.removeprefix('#HTTPRING: ').split(sep=',')
-        if http_response_metadata[2] == '':
-            http_response_metadata[2] = '(not present)'
-        print(f'Received HTTP response on profile {http_response_metadata[0]}, status {http_response_metadata[1]}, content type {http_response_metadata[2]}, {http_response_metadata[3]} bytes')
-        if http_response_metadata[1] != '201':
-            print('HTTP response status is not OK (201); taking a break')
-            time.sleep(break_time)
-
-    time.sleep(data_acquisition_interval)
+            upload_reading(json_data)
+        except Exception as ex:
+            warnings.warn(f"{type(ex).__name__} occured in uploading readings, with arguments {ex.args}")
+
+
+# Readings waiting to be uploaded; if the server is unreachable for long
+# enough for this to fill up, new readings are only saved to the csv file
+uploads = queue.Queue(maxsize=64)
+# A daemon thread does not keep the service alive after SIGTERM
+threading.Thread(target=upload_readings, args=(uploads,), daemon=True).start()
+
+# systemd stops the service with SIGTERM; exit through SystemExit, so that the
+# finally block around the main loop closes (and flushes) the csv file
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+# The csv file is kept open for the lifetime of the service
+# (creating it exclusively tells whether it needs a header)
+try:
+    csvfile = open(csv_file_path, mode="x", newline="", buffering=1 << 16)
+    need_header = True
+except FileExistsError:
+    csvfile = open(csv_file_path, mode="a", newline="", buffering=1 << 16)
+    # The file may have been created by a previous run which never wrote
+    # the header out; appending positions the stream at the end of the file
+    need_header = csvfile.tell() == 0
+print(f"Recording information to {csv_file_path}")
+writer = csv.writer(csvfile)
+if need_header:
+    writer.writerow(csv_fields)
+    # Written out straight away, so an early stop does not leave an empty file
+    csvfile.flush()
+
+# The date column only changes once a day; keep the formatted string until then
+date_fields = None
+# Readings not yet put in the upload queue
+readings = []
+# Readings written since the csv file was last flushed
+rows_since_flush = 0
+# Readings are taken on a fixed cadence, regardless of how long each one takes.
+# The monotonic clock is unaffected by the clock being set at startup
+next_tick = time.monotonic()
+# The interpreter does not finalize the csv file at exit while the uploader
+# thread is alive, so it is closed explicitly, on SIGTERM or on an error
+try:
+    while True:
+        time_struct = time.gmtime(time.time())
+        if time_struct[:3] != date_fields:
+            date_fields = time_struct[:3]
+            date_string = time.strftime("%m/%d/%Y", time_struct)
+        t_degrees_c, rh_percent = SHTC3_sensor.get_temperature_humidity()
+        t_degrees_c = round(t_degrees_c, 2)
+        rh_percent = round(rh_percent, 2)
+        p_hpa = round(LPS22HB_sensor.get_pressure(), 2)
+        # In the same order as csv_fields
+        new_csv_row = (date_string,
+                       f"{time_struct.tm_hour:02d}:{time_struct.tm_min:02d}:{time_struct.tm_sec:02d}",
+                       t_degrees_c,
+                       rh_percent,
+                       p_hpa)
+        print(f"New sensor reading; T: {t_degrees_c} RH: {rh_percent} P: {p_hpa}")
+        writer.writerow(new_csv_row)
+        rows_since_flush += 1
+        # Fewer, larger writes to the SD card
+        if rows_since_flush >= csv_flush_interval:
+            csvfile.flush()
+            rows_since_flush = 0
+        readings.append(reading_json_template.format(t_degrees_c, rh_percent, p_hpa))
+        if len(readings) >= upload_batch_size:
+            if upload_batch_size == 1:
+                json_data = single_json_template.format(device_id, readings[0])
+            else:
+                json_data = batch_json_template.format(device_id, "},{".join(readings))
+            readings = []
+            try:
+                uploads.put_nowait(json_data)
+            except queue.Full:
+                print("Upload queue is full; these readings are only saved to the csv file")
+
+        next_tick += data_acquisition_interval
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+finally:
+    csvfile.close()
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 import warnings
-import os
 import argparse
+import queue
+import signal
+import threading
 import time
 import csv
 import csq
@@ -11,49 +13,66 @@ parser.add_argument("-g", action="store_true", help="Attempt to get a GPS fix")
 parser.add_argument("-o", type=str, default="signal_statistics.csv", help="The csv file in which to save the data. Defaults to %(default)s")
 parser.add_argument("-t", type=int, default=3, help="The number of trials to run. Defaults to %(default)s")
 parser.add_argument("-i", type=float, default=30, help="The number of seconds to wait in between trials. Defaults to %(default)s")
+parser.add_argument("--modems", type=str, default=None, help="Comma separated list of modem serial devices to run trials on in parallel, for example /dev/ttyUSB0,/dev/ttyUSB1. Defaults to autodetecting a single modem")
 argns = parser.parse_args()
 
 filename = argns.o
 trials = argns.t
 trial_interval = argns.i
+# The "Modem" column is only added when running on several modems, so the
+# default output stays compatible with existing CSV files
+record_modem = argns.modems is not None
 
-modem = csq.TelitME910G1()
-# Print some diagnostic information
-modem.self_test()
-modem.sim_test()
-# 30 seconds to fix
-_GNSS_fix = False
-if argns.g:
-    try:
-        modem.await_gnss(tries=10, interval=3)
-        _GNSS_fix = True
-    except RuntimeWarning:
-        print("Unable to acquire GNSS fix")
-        _GNSS_fix = False
-
-# "Oneshot" datapoints; these are acquired only once when the script is run.
-with modem.ser:
-    if modem.AT_query("AT+CTZU?")[-1] == "1":
+# Set on SIGINT so the trial loops stop at the end of the current trial
+_stop = threading.Event()
+
+
+def _interrupt(signum, frame):
+    """Stop the trials gracefully on the first SIGINT; a second one aborts."""
+    _stop.set()
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+
+def setup_modem(modem):
+    """Run diagnostics and acquire the "oneshot" datapoints of a modem.
+
+    These are acquired only once when the script is run.
+
+    Returns:
+        A dictionary with keys "gnss_fix", "network_time", "date", "lat",
+        "lon" and "lte_ue_category".
+    """
+    # Print some diagnostic information
+    modem.self_test()
+    modem.sim_test()
+    # 30 seconds to fix
+    _GNSS_fix = False
+    if argns.g:
+        _GNSS_fix = modem.await_gnss(tries=10, interval=3) is not None
+        if not _GNSS_fix:
+            print("Unable to acquire GNSS fix")
+
+    _network_time_up_to_date = False
+    lat = "N/A"
+    lon = "N/A"
+    if modem.cmd_query("AT+CTZU?")[-1] == "1":
         _network_time_up_to_date = True
     # Only execute this chunk if GNSS has a fix
     if _GNSS_fix:
-        date, _, lat, lon = modem.parse_gpsacp(modem.AT_query("AT$GPSACP"))
+        date, _, lat, lon = modem.parse_gpsacp(modem.cmd_query("AT$GPSACP"))
         warnings.warn("Unable to acquire location and date via GNSS; falling back to network-provided date", RuntimeWarning)
     elif _network_time_up_to_date:
         print("Using WWAN for time and date instead of GNSS")
-        date, _ = modem.parse_cclk(modem.AT_query("AT+CCLK?"))
-        lat = "N/A"
-        lon = "N/A"
+        date, _ = modem.parse_cclk(modem.cmd_query("AT+CCLK?"))
     else:
         date = "N/A"
         warnings.warn("Modem real-time clock is not configured to automatically update. Use manually recorded time information instead!", RuntimeWarning)
 
     # Set operator format to alphanumeric long form (up to 16 characters)
-    modem.AT_query("AT+COPS=3,0")
-    cops_values = modem.AT_query("AT+COPS?").replace("+COPS: ", "").split(sep=",")
+    modem.cmd_query("AT+COPS=3,0")
+    cops_values = modem.cmd_query("AT+COPS?").removeprefix("+COPS: ").split(sep=",")
     # Check if the modem is registered with an operator
     if len(cops_values) > 1:
-        operator_alphanumeric_name = cops_values[2].strip('"')
         match cops_values[3]:
             case "8":
                 lte_ue_category = "M1"
@@ -64,6 +83,74 @@ with modem.ser:
     else:
         raise RuntimeError("Unknown error in \"AT+COPS?\" query")
 
+    return {"gnss_fix": _GNSS_fix, "network_time": _network_time_up_to_date,
+            "date": date, "lat": lat, "lon": lon,
+            "lte_ue_category": lte_ue_category}
+
+
+def trial_loop(modem, info, trials, rows):
+    """Run the trials on one modem, putting each CSV row onto a queue."""
+    # Trials start on a fixed cadence, regardless of how long each one takes
+    deadline = time.monotonic()
+    for i in range(1, trials+1):
+        # Get time from GNSS, with network time fallback
+        print(f"{modem.chardev}: Trial {i} of {trials} started")
+        # Run this chunk if GNSS has a fix
+        if info["gnss_fix"]:
+            _, utc_time, _, _, = modem.parse_gpsacp(modem.cmd_query("AT$GPSACP"))
+        elif info["network_time"]:
+            # Assume the time is in UTC
+            _, utc_time = modem.parse_cclk(modem.cmd_query("AT+CCLK?"))
+        else:
+            utc_time = "N/A"
+
+        signal_test_results = modem.signal_test()
+        # In the same order as the CSV header
+        row = (info["date"],
+               utc_time,
+               info["lat"],
+               info["lon"],
+               info["lte_ue_category"],
+               signal_test_results["opname"],
+               signal_test_results["plmn"],
+               signal_test_results["earfcn"],
+               signal_test_results["tac"],
+               signal_test_results["rac"],
+               signal_test_results["cellid"],
+               signal_test_results["abnd"],
+               signal_test_results["rssi"],
+               signal_test_results["rsrp"],
+               signal_test_results["rsrq"],
+               signal_test_results["sinr"])
+        if record_modem:
+            row = (modem.chardev,) + row
+        rows.put(row)
+
+        print(f"{modem.chardev}: Trial {i} of {trials} ended")
+        if _stop.is_set():
+            print(f"{modem.chardev}: Interrupted; skipping remaining trials")
+            break
+        if trials > 1 and i < trials:
+            deadline += trial_interval
+            print(f"{modem.chardev}: Waiting until {trial_interval} seconds after the last trial start to start next trial")
+            # Returns early if interrupted
+            if _stop.wait(max(0, deadline - time.monotonic())):
+                print(f"{modem.chardev}: Interrupted; skipping remaining trials")
+                break
+
+
+def write_rows(writer, rows):
+    """Write CSV rows from the queue until None is received."""
+    while (row := rows.get()) is not None:
+        writer.writerow(row)
+
+
+if argns.modems is None:
+    modems = [csq.TelitME910G1()]
+else:
+    modems = [csq.TelitME910G1(port=p) for p in argns.modems.split(sep=",")]
+modem_info = [setup_modem(modem) for modem in modems]
+
 # The CSV header
 header = [
         "Date",
@@ -83,45 +170,40 @@ header = [
         "RSRQ (dB)",
         "SINR (dB)"
         ]
+if record_modem:
+    header.insert(0, "Modem")
 
-with open(filename, mode="a", newline="") as outfile:
-    writer = csv.DictWriter(outfile, header)
-    if os.path.getsize(filename) == 0:
-        writer.writeheader()
+# Creating the file exclusively tells whether it needs a header, without a
+# race between two instances starting at once
+try:
+    outfile = open(filename, mode="x", newline="")
+    need_header = True
+except FileExistsError:
+    outfile = open(filename, mode="a", newline="")
+    # The file may have been created by a previous run which never wrote
+    # the header out; appending positions the stream at the end of the file
+    need_header = outfile.tell() == 0
 
-    for i in range(1, trials+1):
-        # Get time from GNSS, with network time fallback
-        print(f"Trial {i} of {trials} started")
-        with modem.ser:
-            # Run this chunk if GNSS has a fix
-            _use_network_time = True
-            if _GNSS_fix:
-                _, utc_time, _, _, = modem.parse_gpsacp(modem.AT_query("AT$GPSACP"))
-            elif _network_time_up_to_date:
-                # Assume the time is in UTC
-                _, utc_time = modem.parse_cclk(modem.AT_query("AT+CCLK?"))
-            else:
-                utc_time = "N/A"
+with outfile:
+    writer = csv.writer(outfile)
+    if need_header:
+        writer.writerow(header)
+        # Written out straight away, so an early stop does not leave an empty file
+        outfile.flush()
 
-        signal_test_results = modem.signal_test()
-        writer.writerow({"Date": date,
-                         "Time (UTC)": utc_time,
-                         "Latitude (°)": lat,
-                         "Longitude (°)": lon,
-                         "LTE UE Category": lte_ue_category,
-                         "Operator Name": signal_test_results["opname"],
-                         "PLMN": signal_test_results["plmn"],
-                         "EARFCN": signal_test_results["earfcn"],
-                         "TAC": signal_test_results["tac"],
-                         "RAC": signal_test_results["rac"],
-                         "CELLID": signal_test_results["cellid"],
-                         "LTE BAND": signal_test_results["abnd"],
-                         "RSSI (dBm)": signal_test_results["rssi"],
-                         "RSRP (dBm)": signal_test_results["rsrp"],
-                         "RSRQ (dB)": signal_test_results["rsrq"],
-                         "SINR (dB)": signal_test_results["sinr"]})
-
-        print(f"Trial {i} of {trials} ended")
-        if trials > 1 and i < trials:
-            print(f"Waiting {trial_interval} seconds to start next trial")
-            time.sleep(trial_interval)
+    # Each modem has its own serial device, so the trials can run concurrently;
+    # a single thread does all the writing to the CSV file. The threads are
+    # daemonic, so that aborting with a second SIGINT does not wait for them.
+    rows = queue.Queue(maxsize=16)
+    writer_thread = threading.Thread(target=write_rows, args=(writer, rows), daemon=True)
+    writer_thread.start()
+    trial_threads = [threading.Thread(target=trial_loop, args=(modem, info, trials, rows), daemon=True)
+                     for modem, info in zip(modems, modem_info)]
+    # Only now, so that SIGINT still aborts the script during modem setup
+    signal.signal(signal.SIGINT, _interrupt)
+    for thread in trial_threads:
+        thread.start()
+    for thread in trial_threads:
+        thread.join()
+    rows.put(None)
+    writer_thread.join()